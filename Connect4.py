@@ -13,6 +13,12 @@ What it *should* do:
     ~ The player can choose a board size from 1 x 1 to 15 x 15.
     ~ The player can pick their name.
     ~ The player can choose whether to go first or second.
+    ~ The machine players' moves come from a seed that is printed at the start, so a game can be
+      played again with 'python Connect4.py <seed>'.
+    ~ On small boards the smart AI can play perfectly from a tablebase. Build one with
+      'python Connect4.py --tablebase <columns> <rows>' and it gets picked up automatically.
+    ~ 'python Connect4.py --simulate <columns> <rows> <games>' plays lots of games of the smart AI
+      against the dumb one across several processes, without the display.
 What it will NOT do:
     ~ This is Connect 4, not Connect 5, Connect 3 or Connect 1,000,000
     ~ The player cannot name the AI.
@@ -29,8 +35,12 @@ so if you're having any wrapping issues, that could be why.
 # ==================================================================================================
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
+import os
+import sys
+import tempfile
 import numpy as np
-import random
+import multiprocessing
+from multiprocessing import shared_memory
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from matplotlib import style
@@ -129,6 +139,27 @@ class Board:
         if 0. not in self.board.transpose()[column]:
                 result = True
         return result
+
+    def key(self, symbol):
+        """Packs the board into a single integer as seen by the player with the given symbol, who
+        is about to move. Each column takes rows + 1 bits, counted up from the bottom: the
+        player's own disks plus the filled cells. The extra bit per column keeps the sum from
+        carrying, so every position gets its own key."""
+        if symbol == 'B':
+            modifier = 1
+        else:
+            modifier = -1
+        current, mask = 0, 0
+        for column in range(self.columns):
+            for height in range(self.rows):
+                item = self.board[self.rows-1-height][column]
+                if item == 0.:
+                    break
+                bit = 1 << (column * (self.rows + 1) + height)
+                mask |= bit
+                if item == modifier:
+                    current |= bit
+        return current + mask
    
     
 class HumanPlayer:
@@ -163,19 +194,22 @@ class HumanPlayer:
 class StupidMachinePlayer:
     """Defines the StupidMachinePlayer class. This AI will just go anywhere at random.
     Attr: symbol
+          rng
     Name: Forrest
     """
     
-    def __init__(self, name, symbol):
-        """Initializer for the StupidMachinePlayerClass."""
+    def __init__(self, name, symbol, rng=None):
+        """Initializer for the StupidMachinePlayerClass. rng is a NumPy Generator; if none is given
+        a fresh one is made, so pass one from spawn_rngs() if you want to replay the game."""
         self.symbol = symbol
         self.name = name
+        self.rng = rng if rng is not None else np.random.default_rng()
         
     def get_move(self, board):
         """Get a random column."""
-        column = random.randint(0,board.columns - 1)
+        column = int(self.rng.integers(board.columns))
         while board.is_full(column):    # We need to check and make sure that the column isn't full.
-            column = random.randint(0, board.columns - 1)
+            column = int(self.rng.integers(board.columns))
         return column
 
 
@@ -192,20 +226,43 @@ class StupidMachinePlayer:
 class NonStupidMachinePlayer:
     """Defines a machine player that doesn't play like Forrest Gump.
     Attr: symbol
+          rng
+          tablebase
+          cache
+          endgame_cells
     Name: Albert
     """
     
-    def __init__(self, name, symbol):
-        """Initializer for the NonStupidMachinePlayer."""
+    def __init__(self, name, symbol, rng=None, tablebase=None, cache=None, endgame_cells=0):
+        """Initializer for the NonStupidMachinePlayer. rng is only used when Albert runs out of
+        ideas and has to pick a column at random. If a Tablebase is given, Albert plays perfectly
+        on boards of that size. If endgame_cells is set, Albert searches every line to the end
+        once that few cells are left, keeping what he finds in cache if he has one. That's off
+        in the normal game and only used by play_quietly()."""
         self.symbol = symbol
         self.name = name
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.tablebase = tablebase
+        self.cache = cache
+        self.endgame_cells = endgame_cells
     
 
     def get_move(self, board):
         """The AI follows a set of instructions. It first checks whether it can make a row of
         three, then a column of three. Then it checks to see if the
         opponent can make a four anywhere on the next move. If these statements all come back
-        false, then it goes to 2s. It doesn't check the diagonals. It's not that smart."""
+        false, then it goes to 2s. It doesn't check the diagonals. It's not that smart. Unless
+        it has a tablebase for this board, in which case it just looks the answer up, or it has
+        been told to search nearly full boards to the end."""
+        if self.tablebase is not None:
+            move = self.tablebase.best_move(board, self.symbol)
+            if move is not None:
+                return move
+        empty = board.columns * board.rows - np.count_nonzero(board.board)
+        if self.endgame_cells and empty <= self.endgame_cells:
+            move = endgame_move(board, self.symbol, self.cache)
+            if move is not None:
+                return move
         move = self.row_finder(board, 3)    # Check the threes
         if move is None:
             move = self.col_finder(board, 3)
@@ -224,9 +281,9 @@ class NonStupidMachinePlayer:
         if board.is_full(move):
             self.get_move(board)
         if move is None:
-            move = random.randint(0,board.columns - 1)
+            move = int(self.rng.integers(board.columns))
             while board.is_full(move):
-                move = random.randint(0, board.columns - 1) 
+                move = int(self.rng.integers(board.columns))
         return move
     
     def col_finder(self, board, sub_size, opfor=False):
@@ -320,14 +377,17 @@ class Game:
           player2
           current_player
           board
+          seed
     """
     
-    def __init__(self, player1, player2, board):
-        """"Initializer for the Game class."""
+    def __init__(self, player1, player2, board, seed=None):
+        """"Initializer for the Game class. seed is the one the players' random streams were
+        spawned from, kept so that a game can be replayed."""
         self.board = board
         self.player1 = player1
         self.player2 = player2
         self.current_player = player1
+        self.seed = seed
     
     def update_display_file(self):      # ***
         """Updates the save file with the current moves. It is called every time a move is made.
@@ -351,6 +411,9 @@ class Game:
     
     def play(self):
         """"Main method responisble for the game."""
+        if self.seed is not None:
+            print("Game seed: {}. Run 'python Connect4.py {}' to play this game again.".format(
+                self.seed, self.seed))
         while not self.game_over():
             #print(self.board)
             self.update_display_file()  # ***
@@ -402,6 +465,496 @@ class Game:
         return self.current_player
     
     
+# =============================================================================
+# ENDGAME TABLEBASE
+# For small boards (4 x 4, 5 x 4 and friends) we can afford to solve the whole game. build() walks
+# forward from the empty board to find every reachable position, one layer per number of disks,
+# then works backwards from the last layer (retrograde analysis) so that every position knows its
+# outcome and how many moves are left with perfect play. The results are stored as a sorted array
+# of Board.key()s, so a lookup is just a binary search, and the file can be memory-mapped straight
+# off the disk. build() refuses boards over Tablebase.max_cells; 6 x 5 has a couple of billion
+# positions, which wouldn't fit in memory anyway.
+# =============================================================================
+
+class Tablebase:
+    """Defines the Tablebase class.
+    Attr: columns
+          rows
+          table
+          keys
+    Values are from the point of view of the player about to move: 1 for a win, 0 for a draw and
+    -1 for a loss. depth is the number of moves until the game ends.
+    """
+
+    dtype = np.dtype([('key', '<u8'), ('value', 'i1'), ('depth', 'u1')])
+    max_cells = 20      # 5 x 4 has 4 million positions. 6 x 4 has 95 million and needs gigabytes.
+
+    def __init__(self, columns, rows, table):
+        """Initializer for the Tablebase class. table is a sorted structured array of dtype
+        Tablebase.dtype, usually made by build() or load()."""
+        self.columns = columns
+        self.rows = rows
+        self.table = table
+        self.keys = table['key']
+
+    @classmethod
+    def build(cls, columns, rows):
+        """Solves every reachable position on a columns x rows board. Each layer is kept as a
+        sorted array of keys rather than a set, and the table is filled in a layer at a time, so
+        memory use stays within a few times the size of the finished table."""
+        if columns * rows > cls.max_cells:
+            raise ValueError("A {} x {} board is too big for a tablebase; the most it can handle "
+                             "is {} cells.".format(columns, rows, cls.max_cells))
+        # Forward pass: layers[n] holds the key of every position with n disks.
+        layers = [np.zeros(1, dtype='<u8')]
+        for n in range(columns * rows):
+            current, mask, terminal = _unpack(layers[n], columns, rows)
+            children = [child[open_] for _, child, open_ in
+                        _child_keys(current[~terminal], mask[~terminal], columns, rows)]
+            layers.append(np.unique(np.concatenate(children)))
+        table = np.zeros(sum(len(layer) for layer in layers), dtype=cls.dtype)
+        starts = np.cumsum([0] + [len(layer) for layer in layers])
+        for n, layer in enumerate(layers):
+            table['key'][starts[n]:starts[n+1]] = layer
+        del layers
+        # Backward pass: score each layer from the one after it, which is already done.
+        for n in range(columns * rows, -1, -1):
+            layer = table[starts[n]:starts[n+1]]
+            current, mask, terminal = _unpack(layer['key'], columns, rows)
+            won = _is_four(current ^ mask, rows + 1)
+            layer['value'] = np.where(won, -1, 0)    # The last move won, or the board is full.
+            layer['depth'] = 0
+            if n == columns * rows:
+                continue
+            after = table[starts[n+1]:starts[n+2]]
+            best_rank = np.full(len(layer), np.iinfo('i2').min, dtype='i2')
+            for _, child, open_ in _child_keys(current, mask, columns, rows):
+                index = np.minimum(np.searchsorted(after['key'], child), len(after) - 1)
+                value = -after['value'][index].astype('i2')
+                depth = after['depth'][index].astype('i2') + 1
+                rank = np.where(open_ & ~terminal, _rank(value, depth), np.iinfo('i2').min)
+                better = rank > best_rank
+                best_rank[better] = rank[better]
+                layer['value'][better] = value[better]
+                layer['depth'][better] = depth[better]
+        table.sort(order='key')
+        return cls(columns, rows, table)
+
+    def save(self, path):
+        """Writes the table to a .npy file. The board size goes in a trailing record whose key is
+        bigger than any real one, so it stays at the end of the sorted array."""
+        size = np.array([(np.iinfo('<u8').max, self.columns, self.rows)], dtype=self.dtype)
+        np.save(path, np.concatenate([self.table, size]))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Reads a table written by save(). By default the file is memory-mapped rather than
+        read in, so several processes can share one copy."""
+        table = np.load(path, mmap_mode=mmap_mode)
+        columns, rows = int(table[-1]['value']), int(table[-1]['depth'])
+        return cls(columns, rows, table[:-1])
+
+    def covers(self, board):
+        """Returns True if the table was built for a board of this size."""
+        return board.columns == self.columns and board.rows == self.rows
+
+    def probe(self, board, symbol):
+        """Returns (value, depth) for the player with the given symbol to move, or None if the
+        board isn't covered or the position can't be reached in a real game."""
+        if not self.covers(board):
+            return None
+        return self.lookup(board.key(symbol))
+
+    def lookup(self, key):
+        """Returns (value, depth) for a Board.key(), or None if it isn't in the table."""
+        index = np.searchsorted(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return None
+        return int(self.table[index]['value']), int(self.table[index]['depth'])
+
+    def best_move(self, board, symbol):
+        """Returns the column that a perfect player with the given symbol would pick, or None if
+        the position isn't in the table. Wins are taken as quickly as possible, and losses put
+        off as long as possible."""
+        if not self.covers(board):
+            return None
+        key = board.key(symbol)
+        mask = _mask_from_key(key, self.columns, self.rows)
+        return _best_column(key - mask, mask, self.columns, self.rows,
+                            lambda current, mask: self.lookup(current + mask))
+
+
+def tablebase_path(columns, rows):
+    """Where the tablebase for a columns x rows board is saved, next to this file."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(directory, 'tablebase_{}x{}.npy'.format(columns, rows))
+
+
+def load_tablebase(columns, rows):
+    """Loads the saved tablebase for a columns x rows board, or returns None if there isn't one."""
+    path = tablebase_path(columns, rows)
+    if not os.path.exists(path):
+        return None
+    return Tablebase.load(path)
+
+
+def check_tablebase():
+    """Quick self-check of the tablebase and the key encoding it relies on. Raises an
+    AssertionError if anything is off. Run it with 'python Connect4.py --check'."""
+    # Board.key() and _mask_from_key() have to agree, or nothing can be looked up.
+    rng = np.random.default_rng(0)
+    for columns, rows in ((4, 4), (5, 4), (7, 6)):
+        for _ in range(100):
+            board = Board(columns, rows)
+            for _ in range(rng.integers(columns * rows + 1)):
+                open_columns = [c for c in range(columns) if not board.is_full(c)]
+                board.change_board(rng.choice(open_columns), rng.choice(['B', 'R']))
+            key = board.key('B')
+            mask = _mask_from_key(key, columns, rows)
+            assert bin(mask).count('1') == np.count_nonzero(board.board)
+            assert bin(key - mask).count('1') == np.count_nonzero(board.board == 1)
+            _, array_mask, _ = _unpack(np.array([key], dtype='<u8'), columns, rows)
+            assert int(array_mask[0]) == mask
+    # 4 x 4 is a draw with perfect play, which takes all 16 moves.
+    tablebase = Tablebase.build(4, 4)
+    assert len(tablebase.table) == 161029
+    board = Board(4, 4)
+    assert tablebase.probe(board, 'B') == (0, 16)
+    for column, symbol in zip((0, 0, 1, 1, 2, 2), 'BRBRBR'):
+        board.change_board(column, symbol)
+    assert tablebase.probe(board, 'B') == (1, 1)    # Three along the bottom, one move from four.
+    assert tablebase.best_move(board, 'B') == 3
+    # What goes onto the disk has to come back off it.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tablebase_4x4.npy')
+        tablebase.save(path)
+        loaded = Tablebase.load(path)
+        assert (loaded.columns, loaded.rows) == (4, 4)
+        assert np.array_equal(loaded.table, tablebase.table)
+        assert loaded.probe(board, 'B') == (1, 1)
+        del loaded      # Let go of the memory-mapped file so the directory can be removed.
+
+
+def _is_four(disks, height):
+    """Returns True where the bitboard disks has four in a line. Shifting by 1 checks columns,
+    height checks rows, and height - 1 and height + 1 check the two diagonals. Works on whole
+    arrays of bitboards as well as on single ones."""
+    found = disks & 0
+    for shift in (1, height, height - 1, height + 1):
+        pairs = disks & (disks >> shift)
+        found |= pairs & (pairs >> (2 * shift))
+    return found != 0
+
+
+def _unpack(keys, columns, rows):
+    """Array version of _mask_from_key(). Returns the disks of the player to move, the filled
+    cells, and whether each position is already over."""
+    height = rows + 1
+    mask = np.zeros_like(keys)
+    for column in range(columns):
+        bits = ((keys >> (column * height)) & ((1 << height) - 1)) + 1
+        for row in range(rows):
+            filled = (bits >> (row + 1)) != 0
+            mask |= np.where(filled, np.uint64(1 << (column * height + row)), np.uint64(0))
+    current = keys - mask
+    terminal = _is_four(current ^ mask, height) | (mask == _full_mask(columns, rows))
+    return current, mask, terminal
+
+
+def _child_keys(current, mask, columns, rows):
+    """Array version of _children(). For each column, yields the keys one move on and whether the
+    column had room for the move."""
+    height = rows + 1
+    for column in range(columns):
+        open_ = (mask & (1 << (column * height + rows - 1))) == 0
+        child_mask = mask | (mask + (1 << (column * height)))
+        yield column, (current ^ mask) + child_mask, open_
+
+
+def _rank(value, depth):
+    """Turns (value, depth) scores into numbers where bigger is better, in the same order as
+    _better()."""
+    return np.where(value > 0, 256 - depth, np.where(value < 0, depth - 256, depth))
+
+
+def _full_mask(columns, rows):
+    """The mask of a board with every cell filled."""
+    return sum(((1 << rows) - 1) << (column * (rows + 1)) for column in range(columns))
+
+
+def _mask_from_key(key, columns, rows):
+    """Undoes Board.key() to get the filled cells back. A column holding n disks comes out as a
+    number between 2**n - 1 and 2**(n+1) - 2, so n can be read off the bit length."""
+    height = rows + 1
+    mask = 0
+    for column in range(columns):
+        bits = (key >> (column * height)) & ((1 << height) - 1)
+        mask |= ((1 << ((bits + 1).bit_length() - 1)) - 1) << (column * height)
+    return mask
+
+
+def _children(current, mask, columns, rows, with_column=False):
+    """Generates the positions one move on from (current, mask), as seen by the opponent."""
+    height = rows + 1
+    for column in range(columns):
+        if mask & (1 << (column * height + rows - 1)):
+            continue
+        child = (current ^ mask, mask | (mask + (1 << (column * height))))
+        if with_column:
+            yield column, child
+        else:
+            yield child
+
+
+def _best_column(current, mask, columns, rows, score):
+    """Returns the column that leads to the best child of (current, mask), where score gives a
+    child's (value, depth) from the opponent's point of view. Returns None if there are no moves
+    or score doesn't know one of the children."""
+    children = []
+    for column, child in _children(current, mask, columns, rows, with_column=True):
+        child_score = score(*child)
+        if child_score is None:
+            return None
+        children.append((column, child_score))
+    if not children:
+        return None
+    best = _best([child for column, child in children])
+    for column, (value, depth) in children:
+        if (-value, depth + 1) == best:
+            return column
+
+
+def _best(scores):
+    """Picks the best (value, depth) for the player to move from the children's scores, which are
+    from the opponent's point of view."""
+    best = None
+    for value, depth in scores:
+        score = (-value, depth + 1)
+        if best is None or _better(score, best):
+            best = score
+    return best
+
+
+def _better(a, b):
+    """Compares two (value, depth) scores. A higher value wins; then a quick win beats a slow one,
+    and a slow loss or draw beats a quick one."""
+    if a[0] != b[0]:
+        return a[0] > b[0]
+    if a[0] > 0:
+        return a[1] < b[1]
+    return a[1] > b[1]
+
+
+# =============================================================================
+# SHARED TRANSPOSITION CACHE
+# When searches or simulations run in a process pool, each worker would otherwise build up its own
+# cache and throw it away at the end. This one lives in a fixed-size block of shared memory, so the
+# total RAM used is decided up front and every worker sees every other worker's results. Entries
+# are keyed by Board.key(). Each bucket has two slots: the first keeps whichever entry had the
+# most work put into it (the biggest depth), the second just takes whatever came in last. Rather
+# than one big lock, there is a row of locks and each bucket uses one of them, so workers only get
+# in each other's way when they happen to hit the same stripe.
+# =============================================================================
+
+class TranspositionCache:
+    """Defines the TranspositionCache class.
+    Attr: columns
+          rows
+          buckets
+          locks
+          table
+    A Board.key() only means something for one board size, so each cache belongs to one board
+    size and solve() won't use it for any other. Hand the cache to pool workers through the
+    initializer arguments; it gets pickled as the name of the shared block plus the locks, and
+    the worker attaches to the same memory. The locks can only be pickled while a worker is being
+    started, and only to a worker with the start method the cache was made under, so it can't be
+    passed as an argument to pool.map() or put on a queue.
+    """
+
+    dtype = np.dtype([('key', '<u8'), ('value', 'i1'), ('depth', 'u1'), ('filled', 'u1')])
+
+    def __init__(self, size, columns, rows, stripes=64):
+        """Initializer for the TranspositionCache class. size is the most entries the cache will
+        hold, rounded up to a power of two, and columns x rows is the board it's for."""
+        self.columns = columns
+        self.rows = rows
+        bits = max(int(size) - 1, 1).bit_length()
+        self.buckets = 1 << (bits - 1)
+        self.locks = [multiprocessing.Lock() for _ in range(stripes)]
+        self.memory = shared_memory.SharedMemory(create=True,
+                                                 size=self.buckets * 2 * self.dtype.itemsize)
+        self.owner = True
+        self.table = np.ndarray((self.buckets, 2), dtype=self.dtype, buffer=self.memory.buf)
+        self.table['filled'] = 0
+
+    def __getstate__(self):
+        """Only the name of the shared block travels to other processes, not its contents."""
+        try:
+            self.locks[0].__getstate__()    # The lock itself checks that a process is starting.
+        except RuntimeError as error:
+            raise RuntimeError("A TranspositionCache can only be given to a process when it is "
+                               "started, e.g. through Pool(initializer, initargs), not passed "
+                               "as an argument to a task, and only with the start method it "
+                               "was made under. ({})".format(error)) from None
+        return self.memory.name, self.columns, self.rows, self.buckets, self.locks
+
+    def __setstate__(self, state):
+        """Attaches to a cache made in another process."""
+        name, self.columns, self.rows, self.buckets, self.locks = state
+        self.memory = shared_memory.SharedMemory(name=name)
+        self.owner = False
+        self.table = np.ndarray((self.buckets, 2), dtype=self.dtype, buffer=self.memory.buf)
+
+    def bucket(self, key):
+        """Finds the bucket for a key with Fibonacci hashing, which spreads out the keys of
+        positions that only differ by a disk or two. The key is turned into a plain int first so
+        that NumPy keys, e.g. from Tablebase.keys, don't overflow."""
+        spread = (int(key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        return spread >> (64 - self.buckets.bit_length() + 1)
+
+    def lookup(self, key):
+        """Returns (value, depth) for a Board.key(), or None if it isn't in the cache."""
+        bucket = self.bucket(key)
+        with self.locks[bucket % len(self.locks)]:
+            for entry in self.table[bucket]:
+                if entry['filled'] and entry['key'] == key:
+                    return int(entry['value']), int(entry['depth'])
+        return None
+
+    def store(self, key, value, depth):
+        """Adds an entry. It goes in the first slot if that slot is empty, already holds this
+        key, or holds something shallower; otherwise it goes in the second slot."""
+        bucket = self.bucket(key)
+        with self.locks[bucket % len(self.locks)]:
+            slots = self.table[bucket]
+            first = slots[0]
+            if not first['filled'] or first['key'] == key or first['depth'] <= depth:
+                if first['filled'] and first['key'] != key:
+                    slots[1] = first    # Don't lose the old entry straight away.
+                slots[0] = (key, value, depth, 1)
+            else:
+                slots[1] = (key, value, depth, 1)
+
+    def close(self):
+        """Detaches this process from the cache. The process that made the cache also frees the
+        memory, so it should only close once the workers are done."""
+        self.table = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+# =============================================================================
+# ENDGAME SEARCH AND BATCH SIMULATION
+# Once a board is nearly full there are few enough lines left that Albert can search every one of
+# them to the end, whatever the size of the board. solve() does that, keeping what it finds in a
+# TranspositionCache if it has one. simulate() plays lots of Albert vs Forrest games in a process
+# pool with one cache shared between all the workers, so an endgame solved in one game is there
+# for every other game. Only these simulated Alberts search the endgame; the one you play
+# against in the normal game doesn't. Each game gets its own random streams from the run's seed
+# and its number, so a game that goes wrong can be played again on its own with play_quietly().
+# =============================================================================
+
+def solve(current, mask, columns, rows, cache=None):
+    """Works out (value, depth) for the player to move in (current, mask) by searching every line
+    to the end of the game. Only sensible with a handful of empty cells."""
+    if cache is not None and (cache.columns, cache.rows) != (columns, rows):
+        raise ValueError("That cache is for a {} x {} board, not {} x {}.".format(
+            cache.columns, cache.rows, columns, rows))
+    full = _full_mask(columns, rows)
+    seen = {}
+
+    def search(current, mask):
+        key = current + mask
+        score = seen.get(key)
+        if score is None and cache is not None:
+            score = cache.lookup(key)
+        if score is not None:
+            return score
+        if _is_four(current ^ mask, rows + 1):
+            score = (-1, 0)     # The last move won.
+        elif mask == full:
+            score = (0, 0)
+        else:
+            score = _best([search(*child) for child in _children(current, mask, columns, rows)])
+        seen[key] = score
+        if cache is not None:
+            cache.store(key, *score)
+        return score
+
+    return search(current, mask)
+
+
+def endgame_move(board, symbol, cache=None):
+    """Returns the best column for the player with the given symbol by searching to the end, or
+    None if the board is too big to fit in a key."""
+    if board.columns * (board.rows + 1) > 64:
+        return None
+    key = board.key(symbol)
+    mask = _mask_from_key(key, board.columns, board.rows)
+    return _best_column(key - mask, mask, board.columns, board.rows,
+                        lambda current, mask: solve(current, mask, board.columns, board.rows,
+                                                    cache))
+
+
+def play_quietly(columns, rows, seed, index=0, cache=None):
+    """Plays game number index of a run with the given seed, Albert against Forrest, without
+    the display. Albert goes first in the even games and searches the last 10 cells to the end.
+    Returns the winner's symbol, or None for a draw."""
+    global COLS, ROWS
+    COLS, ROWS = columns, rows      # Board.is_win() and Albert still go by these.
+    forrest_rng, albert_rng = spawn_rngs([seed, index], 2)
+    albert = NonStupidMachinePlayer('Albert', 'B', albert_rng, load_tablebase(columns, rows),
+                                    cache, endgame_cells=10)
+    forrest = StupidMachinePlayer('Forrest', 'R', forrest_rng)
+    if index % 2 == 0:
+        game = Game(albert, forrest, Board(columns, rows), seed)
+    else:
+        game = Game(forrest, albert, Board(columns, rows), seed)
+    while not game.game_over():
+        column = game.current_player.get_move(game.board)
+        game.board.change_board(column, game.current_player.symbol)
+        game.next_player()
+    if game.is_won():
+        return game.winner().symbol
+    return None
+
+
+def simulate(columns, rows, games, seed, processes=None, cache_size=1 << 20):
+    """Plays games games of Albert against Forrest across a process pool and returns what
+    play_quietly() gave for each one. A game that raises an error comes back as the error's
+    repr instead, so one bad game doesn't lose the rest of the run."""
+    cache = TranspositionCache(cache_size, columns, rows)
+    # The game starts as soon as this file is imported, so the workers have to be forked rather
+    # than started fresh. That means this only works where fork does (not Windows).
+    context = multiprocessing.get_context('fork')
+    try:
+        with context.Pool(processes, initializer=_share_cache, initargs=(cache,)) as pool:
+            tasks = ((columns, rows, seed, index) for index in range(games))
+            return list(pool.imap(_simulate_game, tasks, chunksize=64))
+    finally:
+        cache.close()
+
+
+_worker_cache = None
+
+
+def _share_cache(cache):
+    """Pool initializer that hands each worker the shared cache."""
+    global _worker_cache
+    _worker_cache = cache
+
+
+def _simulate_game(task):
+    """Runs one game for simulate() inside a worker."""
+    columns, rows, seed, index = task
+    try:
+        return play_quietly(columns, rows, seed, index, _worker_cache)
+    except Exception as error:
+        return repr(error)
+
+
+
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++    
 # =================================================================================================
 #  INITIALIZER AND EXTRAS
@@ -491,21 +1044,89 @@ def get_user_parameters():
     return player1, player2, int(cols), int(rows), first
  
     
-def user_params():
-    """Instantiates the players, board, and sets up the game."""
+def spawn_rngs(seed, count):
+    """Returns count independent NumPy Generators spawned from seed. Give one to each player (or
+    each worker when running lots of games in parallel) and the whole run can be replayed from the
+    one seed. seed can be None, in which case fresh entropy is used."""
+    return [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(count)]
+
+
+USAGE = """Usage:
+    python Connect4.py [seed]
+    python Connect4.py --tablebase <columns> <rows>
+    python Connect4.py --simulate <columns> <rows> <games> [seed]
+    python Connect4.py --check"""
+
+
+def command_line():
+    """Reads the seed off the command line, if there is one, e.g. 'python Connect4.py 1234'.
+    Returns None otherwise, so a new seed gets picked. 'python Connect4.py --tablebase 5 4'
+    builds and saves the tablebase for that board instead of playing, 'python Connect4.py
+    --simulate 7 6 1000 [seed]' plays 1000 games of Albert against Forrest with simulate(), and
+    'python Connect4.py --check' runs check_tablebase(). Anything else prints USAGE and stops."""
+    args = sys.argv[1:]
+    option, numbers = None, args
+    if args and args[0].startswith('--'):
+        option, numbers = args[0], args[1:]
+    counts = {None: (0, 1), '--tablebase': (2,), '--simulate': (3, 4), '--check': (0,)}
+    if option not in counts or len(numbers) not in counts[option]:
+        sys.exit(USAGE)
+    if not all(number.isnumeric() for number in numbers):
+        sys.exit(USAGE)
+    numbers = [int(number) for number in numbers]
+    if option in ('--tablebase', '--simulate') and 0 in numbers[:3]:
+        sys.exit(USAGE)     # Board sizes and game counts need to be at least 1. Seeds can be 0.
+    if option == '--tablebase':
+        cols, rows = numbers
+        try:
+            tablebase = Tablebase.build(cols, rows)
+        except ValueError as error:
+            sys.exit(str(error))
+        tablebase.save(tablebase_path(cols, rows))
+        print("Saved {}.".format(tablebase_path(cols, rows)))
+        sys.exit()
+    if option == '--simulate':
+        cols, rows, games = numbers[:3]
+        seed = numbers[3] if len(numbers) == 4 else np.random.SeedSequence().entropy
+        results = simulate(cols, rows, games, seed)
+        print("Albert won {}, Forrest won {}, {} draws.".format(
+            results.count('B'), results.count('R'), results.count(None)))
+        for index, result in enumerate(results):
+            if result not in ('B', 'R', None):
+                print("Game {} failed with {}. play_quietly({}, {}, {}, {}) plays it again.".format(
+                    index, result, cols, rows, seed, index))
+        print("Seed: {}".format(seed))
+        sys.exit()
+    if option == '--check':
+        check_tablebase()
+        print("Tablebase checks passed.")
+        sys.exit()
+    if numbers:
+        return numbers[0]
+    return None
+    
+
+def user_params(seed=None):
+    """Instantiates the players, board, and sets up the game. The seed comes from the argument,
+    then the command line, and failing both is made up fresh."""
+    if seed is None:
+        seed = command_line()
     p1, p2, cols, rows, first  = get_user_parameters()
+    if seed is None:
+        seed = np.random.SeedSequence().entropy    # Keep hold of it so the game can be replayed.
+    rng, = spawn_rngs(seed, 1)
     if type(p2) is int:
         if p2 == 0:
-            player2 = StupidMachinePlayer('Forrest', 'B')
+            player2 = StupidMachinePlayer('Forrest', 'B', rng)
         else:
-            player2 = NonStupidMachinePlayer('Albert', 'B')
+            player2 = NonStupidMachinePlayer('Albert', 'B', rng, load_tablebase(cols, rows))
     else:
         player2 = HumanPlayer(p2, 'B')
     player1 = HumanPlayer(p1, 'R')  
     board = Board(cols, rows)
     if first is False:
         player1, player2 = player2, player1
-    game = Game(player1, player2, board) 
+    game = Game(player1, player2, board, seed) 
     return cols, rows, game
 
 global COLS, ROWS, GAME             # This is horrible practice, I know, but I couldn't really find